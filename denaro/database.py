@@ -131,11 +131,11 @@ class Database:
         blocks_to_remove = await self.get_blocks(block_no, 500)
         transactions_to_remove = []
         # cache overwritten tx hashes
-        transactions_hashes = []
+        transactions_hashes = set()
         for block_to_remove in blocks_to_remove:
             # load transactions of overwritten blocks
             transactions_to_remove.extend([await Transaction.from_hex(tx, False) for tx in block_to_remove['transactions']])
-            transactions_hashes.extend([sha256(tx) for tx in block_to_remove['transactions']])
+            transactions_hashes.update(sha256(tx) for tx in block_to_remove['transactions'])
         outputs_to_be_restored = []
         for transaction in transactions_to_remove:
             if isinstance(transaction, Transaction):
@@ -415,16 +415,16 @@ class Database:
             await connection.executemany('INSERT INTO pending_spent_outputs (tx_hash, index) VALUES ($1, $2)', outputs)
 
     async def add_transactions_pending_spent_outputs(self, transactions: List[Transaction]) -> None:
-        outputs = sum([[(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs] for transaction in transactions], [])
+        outputs = [(tx_input.tx_hash, tx_input.index) for transaction in transactions for tx_input in transaction.inputs]
         async with self.pool.acquire() as connection:
             await connection.executemany('INSERT INTO pending_spent_outputs (tx_hash, index) VALUES ($1, $2)', outputs)
 
     async def add_unspent_transactions_outputs(self, transactions: List[Transaction]) -> None:
-        outputs = sum([[(transaction.hash(), index, output.address) for index, output in enumerate(transaction.outputs)] for transaction in transactions], [])
+        outputs = [(transaction.hash(), index, output.address) for transaction in transactions for index, output in enumerate(transaction.outputs)]
         await self.add_unspent_outputs(outputs)
 
     async def remove_unspent_outputs(self, transactions: List[Transaction]) -> None:
-        inputs = sum([[(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs] for transaction in transactions], [])
+        inputs = [(tx_input.tx_hash, tx_input.index) for transaction in transactions for tx_input in transaction.inputs]
         try:
             async with self.pool.acquire() as connection:
                 await connection.execute('DELETE FROM unspent_outputs WHERE (tx_hash, index) = ANY($1::tx_output[])', inputs)
@@ -432,7 +432,7 @@ class Database:
             await self.remove_unspent_outputs(transactions)
 
     async def remove_pending_spent_outputs(self, transactions: List[Transaction]) -> None:
-        inputs = sum([[(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs] for transaction in transactions], [])
+        inputs = [(tx_input.tx_hash, tx_input.index) for transaction in transactions for tx_input in transaction.inputs]
         async with self.pool.acquire() as connection:
             await connection.execute('DELETE FROM pending_spent_outputs WHERE (tx_hash, index) = ANY($1::tx_output[])', inputs)
 
@@ -444,7 +444,7 @@ class Database:
     async def get_unspent_outputs_hash(self) -> str:
         async with self.pool.acquire() as connection:
             rows = await connection.fetch('SELECT tx_hash, index FROM unspent_outputs ORDER BY tx_hash, index')
-            return sha256(''.join(row['tx_hash'] + bytes([row['index']]).hex() for row in rows))
+            return sha256(''.join(f"{row['tx_hash']}{row['index']:02x}" for row in rows))
 
     async def get_pending_spent_outputs(self, outputs: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
         async with self.pool.acquire() as connection:
@@ -505,7 +505,7 @@ class Database:
         async with self.pool.acquire() as connection:
             txs = await connection.fetch("SELECT tx_hex FROM pending_transactions WHERE $1 && inputs_addresses", addresses)
             txs = [await Transaction.from_hex(tx['tx_hex'], check_signatures) for tx in txs]
-        return sum([[{'tx_hash': tx_input.tx_hash, 'index': tx_input.index} for tx_input in tx.inputs] for tx in txs], [])
+        return [{'tx_hash': tx_input.tx_hash, 'index': tx_input.index} for tx in txs for tx_input in tx.inputs]
 
     async def get_spendable_outputs(self, address: str, check_pending_txs: bool = False) -> List[TransactionInput]:
         point = string_to_point(address)
@@ -546,7 +546,7 @@ class Database:
             spending_txs = await connection.fetch('SELECT tx_hex, blocks.id AS block_no FROM transactions INNER JOIN blocks ON (transactions.block_hash = blocks.hash) WHERE $1 = ANY(inputs_addresses) AND blocks.id >= $2 LIMIT $2', address, block_no)
         unspent_outputs = [TransactionInput(tx_hash, index, amount=Decimal(amount) / SMALLEST, public_key=point) for tx_hash, index, amount in unspent_outputs]
         spending_txs = [await Transaction.from_hex(tx['tx_hex'], False) for tx in spending_txs]
-        spent_outputs = sum([tx.inputs for tx in spending_txs], [])
+        spent_outputs = [tx_input for tx in spending_txs for tx_input in tx.inputs]
         return unspent_outputs, spent_outputs
 
     async def get_nice_transaction(self, tx_hash: str, address: str = None):
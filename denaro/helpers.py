@@ -3,6 +3,7 @@ import json
 import logging
 import sys
 from enum import Enum
+from functools import lru_cache
 from math import ceil
 from datetime import datetime, timezone
 from typing import Union
@@ -86,6 +87,8 @@ def bytes_to_point(point_bytes: bytes) -> Point:
         raise NotImplementedError()
 
 
+# every transaction output is decoded through here, outputs to the same address (pools, exchanges) recur all the time
+@lru_cache(maxsize=4096)
 def bytes_to_string(point_bytes: bytes) -> str:
     point = bytes_to_point(point_bytes)
     if len(point_bytes) == 64:
@@ -117,6 +120,8 @@ def string_to_bytes(string: str) -> bytes:
     return point_bytes
 
 
+# addresses repeat constantly across transactions, decoding them (a modular square root for compressed ones) is not cheap
+@lru_cache(maxsize=4096)
 def string_to_point(string: str) -> Point:
     return bytes_to_point(string_to_bytes(string))
 
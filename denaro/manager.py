@@ -1,13 +1,16 @@
 import hashlib
+import struct
+from asyncio import gather, Lock
+from bisect import bisect_right
 from decimal import Decimal
-from io import BytesIO
+from functools import lru_cache
 from math import ceil, floor, log
-from typing import Tuple, List, Union
+from typing import Callable, Tuple, List, Union
 
 from icecream import ic
 
 from . import Database
-from .constants import MAX_SUPPLY, ENDIAN, MAX_BLOCK_SIZE_HEX
+from .constants import MAX_SUPPLY, MAX_BLOCK_SIZE_HEX
 from .database import OLD_BLOCKS_TRANSACTIONS_ORDER
 from .helpers import sha256, timestamp, bytes_to_string, string_to_bytes
 from .transactions import CoinbaseTransaction, Transaction
@@ -15,16 +18,24 @@ from .transactions import CoinbaseTransaction, Transaction
 BLOCK_TIME = 180
 BLOCKS_COUNT = Decimal(500)
 START_DIFFICULTY = Decimal('6.0')
+DECIMAL_TEN = Decimal(10)
+DECIMAL_SIXTEEN = Decimal(16)
+# previous hash, address, merkle tree, timestamp, difficulty * 10, random (little endian)
+BLOCK_HEADER_V1 = struct.Struct('<32s64s32sIHI')
+BLOCK_HEADER_V2 = struct.Struct('<B32s33s32sIHI')
+BLOCK_CONTENT_HEX_SIZES = (BLOCK_HEADER_V1.size * 2, BLOCK_HEADER_V2.size * 2)
 
 _print = print
 print = ic
 
 
+@lru_cache(maxsize=512)
 def difficulty_to_hashrate_old(difficulty: Decimal) -> int:
     decimal = difficulty % 1 or 1/16
     return Decimal(16 ** int(difficulty) * (16 * decimal))
 
 
+@lru_cache(maxsize=512)
 def difficulty_to_hashrate(difficulty: Decimal) -> int:
     decimal = difficulty % 1
     return Decimal(16 ** int(difficulty) * (16 / ceil(16 * (1 - decimal))))
@@ -34,7 +45,7 @@ def hashrate_to_difficulty_old(hashrate: int) -> Decimal:
     difficulty = int(log(hashrate, 16))
     if hashrate == 16 ** difficulty:
         return Decimal(difficulty)
-    return Decimal(difficulty + (hashrate / Decimal(16) ** difficulty) / 16)
+    return Decimal(difficulty + (hashrate / DECIMAL_SIXTEEN ** difficulty) / 16)
 
 
 def hashrate_to_difficulty_wrong(hashrate: int) -> Decimal:
@@ -44,24 +55,20 @@ def hashrate_to_difficulty_wrong(hashrate: int) -> Decimal:
     ratio = hashrate / 16 ** difficulty
 
     decimal = 16 / ratio / 16
-    decimal = 1 - floor(decimal * 10) / Decimal(10)
+    decimal = 1 - floor(decimal * 10) / DECIMAL_TEN
     return Decimal(difficulty + decimal)
 
 
+HASHRATE_COEFFICIENTS = tuple(16 / ceil(16 * (1 - i / 10)) for i in range(0, 10))
+
+
 def hashrate_to_difficulty(hashrate: int) -> Decimal:
     difficulty = int(log(hashrate, 16))
     ratio = hashrate / 16 ** difficulty
 
-    for i in range(0, 10):
-        coeff = 16 / ceil(16 * (1 - i / 10))
-        if coeff > ratio:
-            decimal = (i - 1) / Decimal(10)
-            return Decimal(difficulty + decimal)
-        if coeff == ratio:
-            decimal = i / Decimal(10)
-            return Decimal(difficulty + decimal)
-
-    return Decimal(difficulty) + Decimal('0.9')
+    # coefficients are strictly increasing, the step is the last one not greater than ratio
+    step = bisect_right(HASHRATE_COEFFICIENTS, ratio) - 1
+    return Decimal(difficulty + step / DECIMAL_TEN)
 
 
 async def calculate_difficulty() -> Tuple[Decimal, dict]:
@@ -75,6 +82,10 @@ async def calculate_difficulty() -> Tuple[Decimal, dict]:
         return START_DIFFICULTY, last_block
 
     if last_block['id'] % BLOCKS_COUNT == 0:
+        # the adjustment only depends on the last block, reuse it until the chain moves
+        adjustment_key = last_block['id'], last_block['hash']
+        if Manager.adjusted_difficulty is not None and Manager.adjusted_difficulty[0] == adjustment_key:
+            return Manager.adjusted_difficulty[1], last_block
         last_adjust_block = await database.get_block_by_id(last_block['id'] - BLOCKS_COUNT + 1)
         elapsed = last_block['timestamp'] - last_adjust_block['timestamp']
         average_per_block = elapsed / BLOCKS_COUNT
@@ -89,11 +100,12 @@ async def calculate_difficulty() -> Tuple[Decimal, dict]:
         hashrate *= ratio
         if last_block['id'] < 17500:
             new_difficulty = hashrate_to_difficulty_old(hashrate)
-            new_difficulty = floor(new_difficulty * 10) / Decimal(10)
+            new_difficulty = floor(new_difficulty * 10) / DECIMAL_TEN
         elif last_block['id'] < 180_000:
             new_difficulty = hashrate_to_difficulty_wrong(hashrate)
         else:
             new_difficulty = hashrate_to_difficulty(hashrate)
+        Manager.adjusted_difficulty = adjustment_key, new_difficulty
         return new_difficulty, last_block
 
     return last_block['difficulty'], last_block
@@ -101,42 +113,74 @@ async def calculate_difficulty() -> Tuple[Decimal, dict]:
 
 async def get_difficulty() -> Tuple[Decimal, dict]:
     if Manager.difficulty is None:
-        Manager.difficulty = await calculate_difficulty()
+        async with Manager.difficulty_lock:
+            # another task may have calculated it while we were waiting
+            if Manager.difficulty is None:
+                Manager.difficulty = await calculate_difficulty()
     return Manager.difficulty
 
 
-async def check_block_is_valid(block_content: str, mining_info: tuple = None) -> bool:
+def get_proof_of_work_target(difficulty: Union[Decimal, float], last_block_hash: str) -> Tuple[int, int, int, int]:
+    decimal = difficulty % 1
+    difficulty = floor(difficulty)
+    # the hash must start with the last `difficulty` nibbles of the previous hash (all of them when difficulty is 0)
+    prefix_bits = (difficulty or 64) * 4
+    chunk = int(last_block_hash, 16) & ((1 << prefix_bits) - 1)
+    # the following nibble must be lower than ceil(16 * (1 - decimal)), any nibble is fine for whole difficulties
+    count = ceil(16 * (1 - decimal)) if decimal > 0 else 16
+    return 256 - prefix_bits, chunk, 252 - difficulty * 4, count
+
+
+def hash_meets_target(block_hash: int, target: Tuple[int, int, int, int]) -> bool:
+    shift, chunk, nibble_shift, count = target
+    return block_hash >> shift == chunk and (block_hash >> nibble_shift) & 0xf < count
+
+
+def get_proof_of_work_check(difficulty: Union[Decimal, float], last_block_hash: str, prefix: bytes = b'') -> Callable[[bytes], bool]:
+    shift, chunk, nibble_shift, count = get_proof_of_work_target(difficulty, last_block_hash)
+    # hash the constant part of the header only once, the check then receives the rest of it
+    midstate = hashlib.sha256(prefix)
+
+    if count < 16:
+        def check(block_content: bytes) -> bool:
+            block_hash = midstate.copy()
+            block_hash.update(block_content)
+            block_hash = int.from_bytes(block_hash.digest(), 'big')
+            return block_hash >> shift == chunk and (block_hash >> nibble_shift) & 0xf < count
+    else:
+        def check(block_content: bytes) -> bool:
+            block_hash = midstate.copy()
+            block_hash.update(block_content)
+            return int.from_bytes(block_hash.digest(), 'big') >> shift == chunk
+    return check
+
+
+async def check_block_is_valid(block_content: str, mining_info: tuple = None, block_hash: str = None) -> bool:
     if mining_info is None:
         mining_info = await get_difficulty()
     difficulty, last_block = mining_info
 
-    block_hash = sha256(block_content)
-
     if 'hash' not in last_block:
         return True
 
-    last_block_hash = last_block['hash']
+    block_hash = int(block_hash or sha256(block_content), 16)
+    return hash_meets_target(block_hash, get_proof_of_work_target(difficulty, last_block['hash']))
 
-    decimal = difficulty % 1
-    difficulty = floor(difficulty)
-    if decimal > 0:
-        charset = '0123456789abcdef'
-        count = ceil(16 * (1 - decimal))
-        return block_hash.startswith(last_block_hash[-difficulty:]) and block_hash[difficulty] in charset[:count]
-    return block_hash.startswith(last_block_hash[-difficulty:])
+
+HALVING_INTERVAL = 150000
+BLOCK_REWARDS = tuple(Decimal(100) / (2 ** Decimal(divider)) for divider in range(9))
+LAST_BLOCK_REWARDS = (Decimal('0.390625'), Decimal('0.3125'), Decimal(0))
 
 
 def get_block_reward(number: int) -> Decimal:
-    divider = floor(number / 150000)
-    if divider == 0:
-        return Decimal(100)
+    divider = number // HALVING_INTERVAL
     if divider > 8:
-        if number < 150000 * 9 + 458732 - 150000:
-            return Decimal('0.390625')
-        elif number < 150000 * 9 + 458733 - 150000 + 320:
-            return Decimal('0.3125')
-        return Decimal(0)
-    return Decimal(100) / (2 ** Decimal(divider))
+        if number < HALVING_INTERVAL * 9 + 458732 - HALVING_INTERVAL:
+            return LAST_BLOCK_REWARDS[0]
+        elif number < HALVING_INTERVAL * 9 + 458733 - HALVING_INTERVAL + 320:
+            return LAST_BLOCK_REWARDS[1]
+        return LAST_BLOCK_REWARDS[2]
+    return BLOCK_REWARDS[divider]
 
 
 def __check():
@@ -159,42 +203,47 @@ async def clear_pending_transactions(transactions=None):
     database: Database = Database.instance
     await database.clear_duplicate_pending_transactions()
     transactions = transactions or await database.get_pending_transactions_limit(hex_only=True)
-    used_inputs = []
+    used_inputs = set()
+    to_remove = []
     for transaction in transactions:
         if isinstance(transaction, str):
             tx_hash = sha256(transaction)
             transaction = await Transaction.from_hex(transaction, check_signatures=False)
         else:
-            tx_hash = sha256(transaction.hex())
-        tx_inputs = [(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs]
-        if any(used_input in tx_inputs for used_input in used_inputs):
-            await database.remove_pending_transaction(tx_hash)
-            print(f'removed {tx_hash}')
-            return await clear_pending_transactions()
-        used_inputs += tx_inputs
-    unspent_outputs = await database.get_unspent_outputs(used_inputs)
-    double_spend_inputs = set(used_inputs) - set(unspent_outputs)
-    if double_spend_inputs == set(used_inputs):
+            tx_hash = transaction.hash()
+        tx_inputs = {(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs}
+        if tx_inputs & used_inputs:
+            to_remove.append(tx_hash)
+            continue
+        used_inputs |= tx_inputs
+    if to_remove:
+        await database.remove_pending_transactions_by_hash(to_remove)
+        print(f'removed {", ".join(to_remove)}')
+    unspent_outputs = await database.get_unspent_outputs(list(used_inputs))
+    double_spend_inputs = used_inputs.difference(unspent_outputs)
+    if double_spend_inputs == used_inputs:
         await database.remove_pending_transactions()
     elif double_spend_inputs:
-        await database.remove_pending_transactions_by_contains([tx_input[0] + bytes([tx_input[1]]).hex() for tx_input in double_spend_inputs])
+        await database.remove_pending_transactions_by_contains([f'{tx_hash}{index:02x}' for tx_hash, index in double_spend_inputs])
+
+
+def get_transaction_merkle_leaf(transaction: Union[Transaction, str]) -> Tuple[bytes, bytes]:
+    # transaction objects cache their hash, so reuse it instead of hashing the raw bytes again
+    if isinstance(transaction, Transaction):
+        return bytes.fromhex(transaction.hex()), bytes.fromhex(transaction.hash())
+    transaction_bytes = bytes.fromhex(transaction)
+    return transaction_bytes, hashlib.sha256(transaction_bytes).digest()
 
 
 def get_transactions_merkle_tree_ordered(transactions: List[Union[Transaction, str]]):
-    _bytes = bytes()
-    for transaction in transactions:
-        _bytes += hashlib.sha256(bytes.fromhex(transaction.hex() if isinstance(transaction, Transaction) else transaction)).digest()
-    return hashlib.sha256(_bytes).hexdigest()
+    return hashlib.sha256(b''.join(
+        bytes.fromhex(transaction.hash()) if isinstance(transaction, Transaction) else hashlib.sha256(bytes.fromhex(transaction)).digest() for transaction in transactions
+    )).hexdigest()
 
 
 def get_transactions_merkle_tree(transactions: List[Union[Transaction, str]]):
-    _bytes = bytes()
-    transactions_bytes = []
-    for transaction in transactions:
-        transactions_bytes.append(bytes.fromhex(transaction.hex() if isinstance(transaction, Transaction) else transaction))
-    for transaction in sorted(transactions_bytes):
-        _bytes += hashlib.sha256(transaction).digest()
-    return hashlib.sha256(_bytes).hexdigest()
+    leaves = sorted(get_transaction_merkle_leaf(transaction) for transaction in transactions)
+    return hashlib.sha256(b''.join(digest for _, digest in leaves)).hexdigest()
 
 
 def get_transactions_size(transactions: List[Transaction]):
@@ -203,53 +252,55 @@ def get_transactions_size(transactions: List[Transaction]):
 
 def block_to_bytes(last_block_hash: str, block: dict) -> bytes:
     address_bytes = string_to_bytes(block['address'])
-    version = bytes([])
+    difficulty = block['difficulty']
+    fields = (
+        bytes.fromhex(last_block_hash),
+        address_bytes,
+        bytes.fromhex(block['merkle_tree']),
+        block['timestamp'],
+        # difficulty is a Decimal when read from the database, a float when received as json
+        int(difficulty * 10) if isinstance(difficulty, Decimal) else int(float(difficulty) * 10),
+        block['random']
+    )
     if len(address_bytes) != 64:
-        version = bytes([2])
-    return version + \
-           bytes.fromhex(last_block_hash) + \
-           address_bytes + \
-           bytes.fromhex(block['merkle_tree']) + \
-           block['timestamp'].to_bytes(4, byteorder=ENDIAN) + \
-           int(float(block['difficulty']) * 10).to_bytes(2, ENDIAN) \
-           + block['random'].to_bytes(4, ENDIAN)
+        return BLOCK_HEADER_V2.pack(2, *fields)
+    return BLOCK_HEADER_V1.pack(*fields)
 
 
 def split_block_content(block_content: str):
+    # reject anything that is not a version 1 or version 2 header before decoding it
+    assert len(block_content) in BLOCK_CONTENT_HEX_SIZES
     _bytes = bytes.fromhex(block_content)
-    stream = BytesIO(_bytes)
-    if len(_bytes) == 138:
-        version = 1
+    if len(_bytes) == BLOCK_HEADER_V1.size:
+        previous_hash, address, merkle_tree, timestamp, difficulty, random = BLOCK_HEADER_V1.unpack(_bytes)
     else:
-        version = int.from_bytes(stream.read(1), ENDIAN)
+        version = _bytes[0]
         assert version > 1
         if version == 2:
-            assert len(_bytes) == 108
+            assert len(_bytes) == BLOCK_HEADER_V2.size
         else:
             raise NotImplementedError()
-    previous_hash = stream.read(32).hex()
-    address = bytes_to_string(stream.read(64 if version == 1 else 33))
-    merkle_tree = stream.read(32).hex()
-    timestamp = int.from_bytes(stream.read(4), ENDIAN)
-    difficulty = int.from_bytes(stream.read(2), ENDIAN) / Decimal(10)
-    random = int.from_bytes(stream.read(4), ENDIAN)
-    return previous_hash, address, merkle_tree, timestamp, difficulty, random
+        _, previous_hash, address, merkle_tree, timestamp, difficulty, random = BLOCK_HEADER_V2.unpack(_bytes)
+    previous_hash, address, merkle_tree = previous_hash.hex(), bytes_to_string(address), merkle_tree.hex()
+    return previous_hash, address, merkle_tree, timestamp, difficulty / DECIMAL_TEN, random
 
 
-async def check_block(block_content: str, transactions: List[Transaction], mining_info: tuple = None):
+async def check_block(block_content: str, transactions: List[Transaction], mining_info: tuple = None, block_fields: tuple = None, block_hash: str = None):
+    # transactions must not contain coinbase transactions, create_block filters them out
     if mining_info is None:
         mining_info = await calculate_difficulty()
     difficulty, last_block = mining_info
     block_no = last_block['id'] + 1 if last_block != {} else 1
-    previous_hash, address, merkle_tree, content_time, content_difficulty, random = split_block_content(block_content)
+    block_hash = block_hash or sha256(block_content)
+    previous_hash, address, merkle_tree, content_time, content_difficulty, random = block_fields or split_block_content(block_content)
     if block_no == 17972 and last_block['hash'] == 'c3b69440e58e99567571e58486d8f22ed1e3107c50b827c9366294b2637cb1a0':
         if address != 'dbda85e237b90aa669da00f2859e0010b0a62e0fb6e55ba6ca3ce8a961a60c64410bcfb6a038310a3bb6f1a4aaa2de1192cc10e380a774bb6f9c6ca8547f11ab' or \
            content_time != 1638463765 or random != 17660081:
             return False
-    elif not await check_block_is_valid(block_content, mining_info):
+    elif not await check_block_is_valid(block_content, mining_info, block_hash):
         print('block not valid')
         return False
-    if block_no == 143361 and sha256(block_content) == 'a53268dd22d173dd0c9c10d7f6a64f46071c669052186a7855e9cc65e9a46939':
+    if block_no == 143361 and block_hash == 'a53268dd22d173dd0c9c10d7f6a64f46071c669052186a7855e9cc65e9a46939':
         for transaction in transactions:
             if transaction.hash() == '5958b48fa0b1692b112affc7a2be887d24073027f3bef585322f33b5eeca463c':
                 transactions.remove(transaction)  # there are 2 transactions which spend same inputs in this block
@@ -272,21 +323,33 @@ async def check_block(block_content: str, transactions: List[Transaction], minin
         return False
 
     database: Database = Database.instance
-    transactions = [tx for tx in transactions if isinstance(tx, Transaction)]
     if get_transactions_size(transactions) > MAX_BLOCK_SIZE_HEX:
         print('block is too big')
         return False
 
+    # the merkle tree only needs transaction hashes, check it before querying and verifying anything
+    transactions_merkle_tree = get_transactions_merkle_tree(
+        transactions) if block_no >= 22500 else get_transactions_merkle_tree_ordered(transactions)
+    if merkle_tree != transactions_merkle_tree and not (
+        (block_no == 17972 and get_transactions_merkle_tree(transactions) == 'cb52390983d1902bf7d0eb96ed3f8adc359d34b6617dcccd2b610349e0ee8d15') or
+        (block_no == 143361 and transactions_merkle_tree == 'a9a930d5144c70afc1679dbb83551a318d5d5da6744145761962157a48fabd54')
+    ):
+        _print('merkle tree does not match')
+        return False
+
     if transactions:
-        check_inputs = sum([[(tx_input.tx_hash, tx_input.index) for tx_input in transaction.inputs] for transaction in transactions], [])
-        unspent_outputs = await database.get_unspent_outputs(check_inputs)
-        if len(set(check_inputs)) != len(check_inputs) or set(check_inputs) - set(unspent_outputs) != set():
+        check_inputs = [(tx_input.tx_hash, tx_input.index) for transaction in transactions for tx_input in transaction.inputs]
+        input_txs_hash = [tx_hash for tx_hash, _ in check_inputs]
+        unspent_outputs, input_txs = await gather(
+            database.get_unspent_outputs(check_inputs),
+            database.get_transactions_info(input_txs_hash)
+        )
+        check_inputs_set = frozenset(check_inputs)
+        spent_outputs = check_inputs_set.difference(unspent_outputs)
+        if len(check_inputs_set) != len(check_inputs) or spent_outputs:
             print('double spend in block')
-            spent_outputs = set(check_inputs) - set(unspent_outputs)
             print(len(spent_outputs))
             return False
-        input_txs_hash = sum([[tx_input.tx_hash for tx_input in transaction.inputs] for transaction in transactions], [])
-        input_txs = await database.get_transactions_info(input_txs_hash)
         # move after pp('after get_transactions', time.time() - t)
         for transaction in transactions:
             await transaction._fill_transaction_inputs(input_txs)
@@ -296,16 +359,6 @@ async def check_block(block_content: str, transactions: List[Transaction], minin
             print(f'transaction {transaction.hash()} has been not verified')
             return False
 
-    transactions_merkle_tree = get_transactions_merkle_tree(
-        transactions) if block_no >= 22500 else get_transactions_merkle_tree_ordered(transactions)
-    if merkle_tree != transactions_merkle_tree:
-        if block_no == 17972 and get_transactions_merkle_tree(transactions) == 'cb52390983d1902bf7d0eb96ed3f8adc359d34b6617dcccd2b610349e0ee8d15':
-            return True
-        if block_no == 143361 and transactions_merkle_tree == 'a9a930d5144c70afc1679dbb83551a318d5d5da6744145761962157a48fabd54':
-            return True
-        _print('merkle tree does not match')
-        return False
-
     return True
 
 
@@ -317,13 +370,18 @@ async def create_block(block_content: str, transactions: List[Transaction], last
         # fixme temp fix
         difficulty, last_block = await get_difficulty()
         #difficulty = Decimal(str(last_block['difficulty']))
-    if not await check_block(block_content, transactions, (difficulty, last_block)):
+    # coinbase transactions are rebuilt below, only regular transactions are checked and stored
+    transactions = [tx for tx in transactions if type(tx) is Transaction]
+    block_fields = split_block_content(block_content)
+    block_hash = sha256(block_content)
+    if not await check_block(block_content, transactions, (difficulty, last_block), block_fields, block_hash):
         return False
 
     database: Database = Database.instance
     block_no = last_block['id'] + 1 if last_block != {} else 1
-    block_hash = sha256(block_content) if block_no != 17972 else '37cb1a0522c039330775e07d824c94e0422dbfb2dba6dcd421f4dc9f11601672'
-    previous_hash, address, merkle_tree, content_time, content_difficulty, random = split_block_content(block_content)
+    if block_no == 17972:
+        block_hash = '37cb1a0522c039330775e07d824c94e0422dbfb2dba6dcd421f4dc9f11601672'
+    previous_hash, address, merkle_tree, content_time, content_difficulty, random = block_fields
     if block_hash == 'a53268dd22d173dd0c9c10d7f6a64f46071c669052186a7855e9cc65e9a46939':  # block 143361 has a double spend
         for transaction in transactions:
             if transaction.hash() == '5958b48fa0b1692b112affc7a2be887d24073027f3bef585322f33b5eeca463c':
@@ -332,12 +390,13 @@ async def create_block(block_content: str, transactions: List[Transaction], last
     fees = sum(transaction.fees for transaction in transactions)
 
     block_reward = get_block_reward(block_no)
-    coinbase_transaction = CoinbaseTransaction(block_hash, address, block_reward + fees)
+    total_reward = block_reward + fees
+    coinbase_transaction = CoinbaseTransaction(block_hash, address, total_reward)
     if block_no > 35000:
         if not coinbase_transaction.outputs[0].verify():
             return False
 
-    await database.add_block(block_no, block_hash, block_content, address, random, difficulty, block_reward + fees, content_time)
+    await database.add_block(block_no, block_hash, block_content, address, random, difficulty, total_reward, content_time)
     await database.add_transaction(coinbase_transaction, block_hash)
 
     try:
@@ -361,3 +420,5 @@ async def create_block(block_content: str, transactions: List[Transaction], last
 
 class Manager:
     difficulty: Tuple[float, dict] = None
+    adjusted_difficulty: Tuple[Tuple[int, str], Decimal] = None
+    difficulty_lock = Lock()
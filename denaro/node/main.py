@@ -1,12 +1,13 @@
 import random
-from asyncio import gather
-from collections import deque
+from asyncio import create_task, gather, Semaphore
+from collections import OrderedDict
 import os
 from dotenv import dotenv_values
 import re
 import json
 from decimal import Decimal
 from datetime import datetime 
+from typing import Union
 
 from asyncpg import UniqueViolationError
 from fastapi import FastAPI, Body, Query
@@ -41,6 +42,7 @@ db: Database = None
 NodesManager.init()
 started = False
 is_syncing = False
+syncing_nodes = set()
 self_url = None
 
 print = ic
@@ -53,17 +55,34 @@ app.add_middleware(
 )
 
 config = dotenv_values(".env")
+REPEATED_SLASHES = re.compile('/+')
+# every accepted transaction fans out to ~20 nodes, cap the requests in flight across all of them
+propagate_semaphore = Semaphore(50)
+# stale pending transactions are re-broadcast a couple at a time, so they leave most of the slots above to new ones
+propagate_old_transactions_semaphore = Semaphore(2)
+
+
+async def propagate_to_node(node_interface: NodeInterface, path: str, args: Union[dict, bytes], sender_node: str):
+    # blocks are rare and must not queue behind transactions waiting on slow nodes
+    if path == 'push_block':
+        return await node_interface.request(path, args, sender_node)
+    async with propagate_semaphore:
+        return await node_interface.request(path, args, sender_node)
+
 
 async def propagate(path: str, args: dict, ignore_url=None, nodes: list = None):
     global self_url
     self_node = NodeInterface(self_url or '')
     ignore_node = NodeInterface(ignore_url or '')
+    if path in ('push_block', 'push_tx'):
+        # encode the body once instead of once per node
+        args = json.dumps(args).encode()
     aws = []
     for node_url in nodes or NodesManager.get_propagate_nodes():
         node_interface = NodeInterface(node_url)
         if node_interface.base_url == self_node.base_url or node_interface.base_url == ignore_node.base_url:
             continue
-        aws.append(node_interface.request(path, args, self_node.url))
+        aws.append(propagate_to_node(node_interface, path, args, self_node.url))
     for response in await gather(*aws, return_exceptions=True):
         print('node response: ', response)
 
@@ -142,15 +161,18 @@ async def _sync_blockchain(node_url: str = None):
 
     #return
     limit = 1000
+    next_blocks = create_task(node_interface.get_blocks(await db.get_next_block_id(), limit))
     while True:
-        i = await db.get_next_block_id()
         try:
-            blocks = await node_interface.get_blocks(i, limit)
+            blocks = await next_blocks
         except Exception as e:
             print(e)
             #NodesManager.get_nodes().remove(node_url)
             NodesManager.sync()
             break
+        if blocks:
+            # download the next page while this one is being validated
+            next_blocks = create_task(node_interface.get_blocks(blocks[-1]['block']['id'] + 1, limit))
         try:
             _, last_block = await calculate_difficulty()
             if not blocks:
@@ -165,6 +187,7 @@ async def _sync_blockchain(node_url: str = None):
             assert await create_blocks(blocks)
         except Exception as e:
             print(e)
+            next_blocks.cancel()
             if local_cache is not None:
                 print('sync failed, reverting back to previous chain')
                 await db.delete_blocks(last_common_block)
@@ -173,11 +196,18 @@ async def _sync_blockchain(node_url: str = None):
 
 
 async def sync_blockchain(node_url: str = None):
+    # every block pushed by a node we are behind schedules a sync from it, run only one per node at a time
+    sync_key = node_url.strip('/') if node_url else None
+    if sync_key in syncing_nodes:
+        return
+    syncing_nodes.add(sync_key)
     try:
         await _sync_blockchain(node_url)
     except Exception as e:
         print(e)
         return
+    finally:
+        syncing_nodes.discard(sync_key)
 
 
 @app.on_event("startup")
@@ -197,10 +227,17 @@ async def root():
     return {"version": VERSION, "unspent_outputs_hash": await db.get_unspent_outputs_hash()}
 
 
+async def propagate_old_transaction(tx_hex: str):
+    async with propagate_old_transactions_semaphore:
+        await propagate('push_tx', {'tx_hex': tx_hex})
+
+
 async def propagate_old_transactions(propagate_txs):
     await db.update_pending_transactions_propagation_time([sha256(tx_hex) for tx_hex in propagate_txs])
-    for tx_hex in propagate_txs:
-        await propagate('push_tx', {'tx_hex': tx_hex})
+    await gather(*(propagate_old_transaction(tx_hex) for tx_hex in propagate_txs))
+
+
+LAST_PROPAGATE_OLD_TRANSACTIONS_CHECK = [0]
 
 
 @app.middleware("http")
@@ -210,17 +247,21 @@ async def middleware(request: Request, call_next):
     hostname = request.base_url.hostname
 
     # Normalize the URL path by removing extra slashes
-    normalized_path = re.sub('/+', '/', request.scope['path'])
-    if normalized_path != request.scope['path']:
+    path = request.scope['path']
+    if '//' in path:
+        normalized_path = REPEATED_SLASHES.sub('/', path)
         url = request.url
-        new_url = str(url).replace(request.scope['path'], normalized_path)
+        new_url = str(url).replace(path, normalized_path)
         #Redirect to normalized URL
         return RedirectResponse(new_url)
 
-    if 'Sender-Node' in request.headers:
-        NodesManager.add_node(request.headers['Sender-Node'])
+    sender_node = request.headers.get('Sender-Node')
+    if sender_node is not None:
+        NodesManager.add_node(sender_node)
 
-    if nodes and not started or (ip_is_local(hostname) or hostname == 'localhost'):
+    # the fetched nodes are only used to announce ourselves on the first public request,
+    # local requests must not wait for a remote node
+    if nodes and not started and not (ip_is_local(hostname) or hostname == 'localhost'):
         try:
             node_url = nodes[0]
             #requests.get(f'{node_url}/add_node', {'url': })
@@ -230,28 +271,31 @@ async def middleware(request: Request, call_next):
         except:
             pass
 
-        if not (ip_is_local(hostname) or hostname == 'localhost'):
-            started = True
+        started = True
 
-            self_url = str(request.base_url).strip('/')
-            try:
-                nodes.remove(self_url)
-            except ValueError:
-                pass
-            try:
-                nodes.remove(self_url.replace("http://", "https://"))
-            except ValueError:
-                pass
+        self_url = str(request.base_url).strip('/')
+        try:
+            nodes.remove(self_url)
+        except ValueError:
+            pass
+        try:
+            nodes.remove(self_url.replace("http://", "https://"))
+        except ValueError:
+            pass
 
-            NodesManager.sync()
+        NodesManager.sync()
 
-            try:
-                await propagate('add_node', {'url': self_url})
-                cousin_nodes = sum(await NodeInterface(url).get_nodes() for url in nodes)
-                await propagate('add_node', {'url': self_url}, nodes=cousin_nodes)
-            except:
-                pass
-    propagate_txs = await db.get_need_propagate_transactions()
+        try:
+            await propagate('add_node', {'url': self_url})
+            cousin_nodes = sum(await NodeInterface(url).get_nodes() for url in nodes)
+            await propagate('add_node', {'url': self_url}, nodes=cousin_nodes)
+        except:
+            pass
+    propagate_txs = None
+    # pending transactions are re-propagated after 10 minutes, no need to look for them on every request
+    if LAST_PROPAGATE_OLD_TRANSACTIONS_CHECK[0] < timestamp() - 60:
+        LAST_PROPAGATE_OLD_TRANSACTIONS_CHECK[0] = timestamp()
+        propagate_txs = await db.get_need_propagate_transactions()
     try:
         response = await call_next(request)
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -270,7 +314,9 @@ async def exception_handler(request: Request, e: Exception):
         content={"ok": False, "error": f"Uncaught {type(e).__name__} exception"},
     )
 
-transactions_cache = deque(maxlen=100)
+# recently accepted transaction hashes, oldest first
+transactions_cache = OrderedDict()
+TRANSACTIONS_CACHE_SIZE = 100
 
 
 @app.get("/push_tx")
@@ -279,19 +325,29 @@ async def push_tx(request: Request, background_tasks: BackgroundTasks, tx_hex: s
     if body and tx_hex is None:
         tx_hex = body['tx_hex']
     tx = await Transaction.from_hex(tx_hex)
-    if tx.hash() in transactions_cache:
+    tx_hash = tx.hash()
+    if tx_hash in transactions_cache:
+        transactions_cache.move_to_end(tx_hash)
         return {'ok': False, 'error': 'Transaction just added'}
+    # reserve the hash before awaiting, so the same transaction pushed concurrently is rejected above
+    transactions_cache[tx_hash] = None
+    if len(transactions_cache) > TRANSACTIONS_CACHE_SIZE:
+        transactions_cache.popitem(last=False)
     try:
         if await db.add_pending_transaction(tx):
-            if 'Sender-Node' in request.headers:
-                NodesManager.update_last_message(request.headers['Sender-Node'])
+            sender_node = request.headers.get('Sender-Node')
+            if sender_node is not None:
+                NodesManager.update_last_message(sender_node)
             background_tasks.add_task(propagate, 'push_tx', {'tx_hex': tx_hex})
-            transactions_cache.append(tx.hash())
             return {'ok': True, 'result': 'Transaction has been accepted'}
         else:
+            transactions_cache.pop(tx_hash, None)
             return {'ok': False, 'error': 'Transaction has not been added'}
     except UniqueViolationError:
         return {'ok': False, 'error': 'Transaction already present'}
+    except Exception:
+        transactions_cache.pop(tx_hash, None)
+        raise
 
 
 @app.post("/push_block")
@@ -299,6 +355,7 @@ async def push_tx(request: Request, background_tasks: BackgroundTasks, tx_hex: s
 async def push_block(request: Request, background_tasks: BackgroundTasks, block_content: str = '', txs='', block_no: int = None, body=Body(False)):
     if is_syncing:
         return {'ok': False, 'error': 'Node is already syncing'}
+    sender_node = request.headers.get('Sender-Node')
     if body:
         txs = body['txs']
         if 'block_content' in body:
@@ -316,15 +373,15 @@ async def push_block(request: Request, background_tasks: BackgroundTasks, block_
     if block_no is None:
         previous_block = await db.get_block(previous_hash)
         if previous_block is None:
-            if 'Sender-Node' in request.headers:
-                background_tasks.add_task(sync_blockchain, request.headers['Sender-Node'])
+            if sender_node is not None:
+                background_tasks.add_task(sync_blockchain, sender_node)
                 return {'ok': False,
                         'error': 'Previous hash not found, had to sync according to sender node, block may have been accepted'}
             else:
                 return {'ok': False, 'error': 'Previous hash not found'}
         block_no = previous_block['id'] + 1
     if next_block_id < block_no:
-        background_tasks.add_task(sync_blockchain, request.headers['Sender-Node'] if 'Sender-Node' in request.headers else None)
+        background_tasks.add_task(sync_blockchain, sender_node)
         return {'ok': False, 'error': 'Blocks missing, had to sync according to sender node, block may have been accepted'}
     if next_block_id > block_no:
         return {'ok': False, 'error': 'Too old block'}
@@ -338,8 +395,8 @@ async def push_block(request: Request, background_tasks: BackgroundTasks, block_
     if hashes:
         pending_transactions = await db.get_pending_transactions_by_hash(hashes)
         if len(pending_transactions) < len(hashes):  # one or more tx not found
-            if 'Sender-Node' in request.headers:
-                background_tasks.add_task(sync_blockchain, request.headers['Sender-Node'])
+            if sender_node is not None:
+                background_tasks.add_task(sync_blockchain, sender_node)
                 return {'ok': False,
                         'error': 'Transaction hash not found, had to sync according to sender node, block may have been accepted'}
             else:
@@ -348,8 +405,8 @@ async def push_block(request: Request, background_tasks: BackgroundTasks, block_
     if not await create_block(block_content, final_transactions):
         return {'ok': False}
 
-    if 'Sender-Node' in request.headers:
-        NodesManager.update_last_message(request.headers['Sender-Node'])
+    if sender_node is not None:
+        NodesManager.update_last_message(sender_node)
 
     background_tasks.add_task(propagate, 'push_block', {
         'block_content': block_content,
@@ -366,8 +423,10 @@ async def sync(request: Request, node_url: str = None):
     if is_syncing:
         return {'ok': False, 'error': 'Node is already syncing'}
     is_syncing = True
-    await sync_blockchain(node_url)
-    is_syncing = False
+    try:
+        await sync_blockchain(node_url)
+    finally:
+        is_syncing = False
 
 
 LAST_PENDING_TRANSACTIONS_CLEAN = [0]
@@ -487,7 +546,10 @@ async def get_block(request: Request, block: str, full_transactions: bool = Fals
 async def get_blocks(request: Request, offset: int, limit: int = Query(default=..., le=1000), pretty: bool = False):
     blocks = await db.get_blocks(offset, limit)
     result = {'ok': True, 'result': blocks}
-    return Response(content=json.dumps(result, indent=4, cls=CustomJSONEncoder), media_type="application/json") if pretty else result
+    if pretty:
+        return Response(content=json.dumps(result, indent=4, cls=CustomJSONEncoder), media_type="application/json")
+    # up to 1000 blocks with all their transactions, encode them directly instead of walking them with jsonable_encoder first
+    return Response(content=json.dumps(result, separators=(',', ':'), default=float), media_type="application/json")
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, o):
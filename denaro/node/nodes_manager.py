@@ -2,6 +2,8 @@ import json
 import os
 from os.path import dirname, exists
 from random import sample
+from time import monotonic
+from typing import Union
 
 import httpx
 import pickledb
@@ -12,6 +14,8 @@ from ..helpers import timestamp
 ACTIVE_NODES_DELTA = 60 * 60 * 24 * 7  # 7 days
 INACTIVE_NODES_DELTA = 60 * 60 * 24 * 90  # 3 months
 MAX_NODES_COUNT = 100
+MAX_LAST_MESSAGES_COUNT = 1000
+PROPAGATE_NODES_TTL = 10
 
 path = dirname(os.path.realpath(__file__)) + '/nodes.json'
 if not exists(path):
@@ -23,9 +27,14 @@ class NodesManager:
     last_messages: dict = None
     nodes: list = None
     db = db
+    # active and never seen nodes, reused by get_propagate_nodes until they expire or the node list changes
+    propagate_candidates: tuple = None
+    propagate_candidates_time: float = 0
 
     timeout = httpx.Timeout(3)
-    async_client = httpx.AsyncClient(timeout=timeout, follow_redirects=True)
+    # keep connections to the propagation nodes open between pushes instead of reconnecting (and redoing tls) each time
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=100, keepalive_expiry=30)
+    async_client = httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=True)
 
     @staticmethod
     def init():
@@ -59,27 +68,35 @@ class NodesManager:
     @staticmethod
     def add_node(node: str):
         node = node.strip('/')
+        # every request from a peer ends up here, known nodes need no eviction pass nor disk write
+        if node in NodesManager.nodes:
+            return
         if len(NodesManager.nodes) > MAX_NODES_COUNT or len(NodesManager.get_zero_nodes()) > 10:
             NodesManager.clear_old_nodes()
         if len(NodesManager.nodes) > MAX_NODES_COUNT:
             raise Exception('Too many nodes')
         NodesManager.init()
         NodesManager.nodes.append(node)
+        NodesManager.propagate_candidates = None
         NodesManager.sync()
 
     @staticmethod
     def get_nodes():
-        NodesManager.init()
-        NodesManager.nodes.extend(NodesManager.last_messages.keys())
-        NodesManager.nodes = [node.strip('/') for node in NodesManager.nodes if len(node)]
-        NodesManager.nodes = list(dict.fromkeys(NodesManager.nodes))
-        NodesManager.sync()
+        # the in-memory state is kept in sync by the writers, only write it back when it changes
+        nodes = [node.strip('/') for node in NodesManager.nodes + list(NodesManager.last_messages) if len(node)]
+        nodes = list(dict.fromkeys(nodes))
+        if nodes != NodesManager.nodes:
+            NodesManager.nodes = nodes
+            NodesManager.propagate_candidates = None
+            NodesManager.sync()
         return NodesManager.nodes
 
     @staticmethod
     def get_recent_nodes():
-        full_nodes = {node_url: NodesManager.get_last_message(node_url) for node_url in NodesManager.get_nodes()}
-        return [item[0] for item in sorted(full_nodes.items(), key=lambda item: item[1], reverse=True) if item[1] > timestamp() - ACTIVE_NODES_DELTA]
+        # drop inactive nodes before sorting, only the recent ones need to be ordered
+        active_since = timestamp() - ACTIVE_NODES_DELTA
+        recent_nodes = {node_url: last_message for node_url in NodesManager.get_nodes() if (last_message := NodesManager.get_last_message(node_url)) > active_since}
+        return sorted(recent_nodes, key=recent_nodes.get, reverse=True)
 
     @staticmethod
     def get_zero_nodes():
@@ -87,29 +104,41 @@ class NodesManager:
 
     @staticmethod
     def get_propagate_nodes():
-        active_nodes = NodesManager.get_recent_nodes()
-        zero_nodes = NodesManager.get_zero_nodes()
+        if NodesManager.propagate_candidates is None or monotonic() - NodesManager.propagate_candidates_time > PROPAGATE_NODES_TTL:
+            NodesManager.propagate_candidates = NodesManager.get_recent_nodes(), NodesManager.get_zero_nodes()
+            NodesManager.propagate_candidates_time = monotonic()
+        active_nodes, zero_nodes = NodesManager.propagate_candidates
         return (sample(active_nodes, k=10) if len(active_nodes) > 10 else active_nodes) + (sample(zero_nodes, k=10) if len(zero_nodes) > 10 else zero_nodes)
+
     @staticmethod
     def clear_old_nodes():
         NodesManager.init()
-        NodesManager.nodes = [node for node in NodesManager.get_nodes() if NodesManager.get_last_message(node) > timestamp() - INACTIVE_NODES_DELTA]
+        active_since = timestamp() - INACTIVE_NODES_DELTA
+        NodesManager.nodes = [node for node in NodesManager.get_nodes() if NodesManager.get_last_message(node) > active_since]
+        NodesManager.propagate_candidates = None
         NodesManager.sync()
 
     @staticmethod
     def get_last_message(node_url: str):
-        NodesManager.init()
-        last_messages = NodesManager.last_messages
-        return last_messages[node_url] if node_url in last_messages else 0
+        return NodesManager.last_messages.get(node_url, 0)
 
     @staticmethod
     def update_last_message(node_url: str):
         NodesManager.init()
-        NodesManager.last_messages[node_url.strip('/')] = timestamp()
+        last_messages = NodesManager.last_messages
+        node_url = node_url.strip('/')
+        # keep the dict ordered from the least to the most recently seen node, so the oldest one is evicted first
+        last_messages.pop(node_url, None)
+        last_messages[node_url] = timestamp()
+        while len(last_messages) > MAX_LAST_MESSAGES_COUNT:
+            del last_messages[next(iter(last_messages))]
         NodesManager.sync()
 
 
 class NodeInterface:
+    # one is built per node on every propagate and sync, and only ever holds these two
+    __slots__ = ('url', 'base_url')
+
     def __init__(self, url: str):
         self.url = url.strip('/')
         self.base_url = self.url.replace('http://', '', 1).replace('https://', '', 1)
@@ -129,10 +158,13 @@ class NodeInterface:
         res = await self.request('get_nodes')
         return res['result']
 
-    async def request(self, path: str, data: dict = {}, sender_node: str = ''):
+    async def request(self, path: str, data: Union[dict, bytes] = {}, sender_node: str = ''):
         headers = {'Sender-Node': sender_node}
         if path in ('push_block', 'push_tx'):
-            r = await NodesManager.request(f'{self.url}/{path}', method='POST', json=data, headers=headers, timeout=10)
+            # data may come already encoded, when the same body is sent to many nodes
+            content = data if isinstance(data, bytes) else json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+            r = await NodesManager.request(f'{self.url}/{path}', method='POST', content=content, headers=headers, timeout=10)
         else:
             r = await NodesManager.request(f'{self.url}/{path}', params=data, headers=headers, timeout=10)
         return r
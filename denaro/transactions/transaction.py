@@ -38,10 +38,13 @@ class Transaction:
         #self.timestamp = timestamp
 
         self._hex: str = None
+        self._full_hex: str = None
         self.fees: Decimal = None
         self.tx_hash: str = None
 
     def hex(self, full: bool = True):
+        if full and self._full_hex is not None:
+            return self._full_hex
         inputs, outputs = self.inputs, self.outputs
         hex_inputs = ''.join(tx_input.tobytes().hex() for tx_input in inputs)
         hex_outputs = ''.join(tx_output.tobytes().hex() for tx_output in outputs)
@@ -78,6 +81,7 @@ class Transaction:
                 signatures.append(signed)
                 self._hex += signed
 
+        self._full_hex = self._hex
         return self._hex
 
     def hash(self):
@@ -176,6 +180,8 @@ class Transaction:
         for input in self.inputs:
             if input.private_key is not None:
                 input.sign(self.hex(False))
+        self._full_hex = None
+        self.tx_hash = None
         return self
 
     async def get_fees(self):
@@ -1,42 +1,29 @@
 import hashlib
+import struct
 import sys
 import time
-from math import ceil
 from multiprocessing import Process
 
 import requests
 
 from denaro.constants import ENDIAN
 from denaro.helpers import string_to_bytes, timestamp
+from denaro.manager import get_proof_of_work_check
 
 
-def get_transactions_merkle_tree(transactions):
-    return hashlib.sha256(b''.join(bytes.fromhex(transaction) for transaction in transactions)).hexdigest()
+def get_transactions_merkle_tree(transactions) -> bytes:
+    return hashlib.sha256(b''.join(bytes.fromhex(transaction) for transaction in transactions)).digest()
 
 
+NONCE = struct.Struct('<I')
 NODE = sys.argv[3].strip('/')+'/' if len(sys.argv) >= 4 else 'http://localhost:3006/'
 
 
 def run(start: int = 0, step: int = 1, res: dict = None):
     difficulty = res['difficulty']
-    decimal = difficulty % 1
     last_block = res['last_block']
     last_block['hash'] = last_block['hash'] if 'hash' in last_block else (30_06_2005).to_bytes(32, ENDIAN).hex()
     last_block['id'] = last_block['id'] if 'id' in last_block else 0
-    chunk = last_block['hash'][-int(difficulty):]
-
-    charset = '0123456789abcdef'
-    if decimal > 0:
-        count = ceil(16 * (1 - decimal))
-        charset = charset[:count]
-        idifficulty = int(difficulty)
-
-        def check_block_is_valid(block_content: bytes) -> bool:
-            block_hash = hashlib.sha256(block_content).hexdigest()
-            return block_hash.startswith(chunk) and block_hash[idifficulty] in charset
-    else:
-        def check_block_is_valid(block_content: bytes) -> bool:
-            return hashlib.sha256(block_content).hexdigest().startswith(chunk)
 
     address = sys.argv[1]
     address_bytes = string_to_bytes(address)
@@ -50,13 +37,17 @@ def run(start: int = 0, step: int = 1, res: dict = None):
         print(f'difficulty: {difficulty}')
         print(f'block number: {last_block["id"]}')
         print(f'Confirming {len(txs)} transactions')
-    prefix = bytes.fromhex(last_block['hash']) + address_bytes + bytes.fromhex(merkle_tree) + a.to_bytes(4, byteorder=ENDIAN) + int(difficulty * 10).to_bytes(2, ENDIAN)
+    prefix = bytes.fromhex(last_block['hash']) + address_bytes + merkle_tree + a.to_bytes(4, byteorder=ENDIAN) + int(difficulty * 10).to_bytes(2, ENDIAN)
     if len(address_bytes) == 33:
         prefix = (2).to_bytes(1, ENDIAN) + prefix
+    # only the last 4 bytes (random) change between attempts, the prefix is hashed once
+    check_block_is_valid = get_proof_of_work_check(difficulty, last_block['hash'], prefix)
     while True:
         found = True
         check = 5000000 * step
-        while not check_block_is_valid(_hex := prefix + i.to_bytes(4, ENDIAN)):
+        while True:
+            if check_block_is_valid(NONCE.pack(i)):
+                break
             if ((i := i + step) - start) % check == 0:
                 elapsed_time = time.time() - t
                 print(f'Worker {start + 1}: ' + str(int(i / step / elapsed_time / 1000)) + 'k hash/s')
@@ -64,6 +55,7 @@ def run(start: int = 0, step: int = 1, res: dict = None):
                     found = False
                     break
         if found:
+            _hex = prefix + NONCE.pack(i)
             print(_hex.hex())
             print(','.join(txs))
             r = requests.post(NODE + 'push_block', json={